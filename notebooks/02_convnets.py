@@ -405,10 +405,12 @@ for epoch in range(max_epochs):
             validation_loss[idx] = loss_.item()
             validation_acc[idx] = acc
 
-    results['train_losses'].append(train_loss.mean())
-    results['train_acc'].append(train_acc.mean())
-    results['validation_losses'].append(validation_loss.mean())
-    results['validation_acc'].append(validation_acc.mean())
+    # .item(): store plain floats, not 0-d tensors. Otherwise every consumer
+    # of these lists (e.g. plotting) has to unbox the tensors one by one.
+    results['train_losses'].append(train_loss.mean().item())
+    results['train_acc'].append(train_acc.mean().item())
+    results['validation_losses'].append(validation_loss.mean().item())
+    results['validation_acc'].append(validation_acc.mean().item())
 
     if epoch % log_every == 0 or (epoch+1) == max_epochs:
         print(f"{epoch+1}/{max_epochs} :: training loss {train_loss.mean()} accuracy {train_acc.mean()}; validation loss {validation_loss.mean()} accuracy {validation_acc.mean()}")
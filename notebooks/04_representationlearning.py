@@ -27,9 +27,9 @@ learning to compress (and denoise) the data, it must classify the inputs by
 label. We will look at its latent representations of the data. Does
 it learn to pay attention to the same data characteristics to solve its task?
 
-**This notebook requires the files `X_latent_h.npy` and `y_latent_h.py` written
-by the autoencoder notebook. If those are not resent, please (re-)run this
-first.**
+**This notebook requires the files `X_latent_h.npy` and `y_latent_h.npy`
+written by the autoencoder notebook. If those are not present, please (re-)run
+this first.**
 """
 
 
@@ -104,9 +104,12 @@ def get_dataloaders(batch_size=64):
 
 
 # %%
-# Load autoencoder latent h produced by the autoencoder notebook.
-X_latent_h = np.load("X_latent_h.npy")
-y_latent_h = np.load("y_latent_h.npy")
+# Load autoencoder latent h produced by the autoencoder notebook. It is
+# stored in reduced precision there; the embedding methods below want
+# float32. mmap_mode pages the file in lazily instead of reading it all at
+# once.
+X_latent_h = np.load("X_latent_h.npy", mmap_mode="r").astype(np.float32)
+y_latent_h = np.load("y_latent_h.npy").astype(np.int64)
 
 
 # %% [markdown]
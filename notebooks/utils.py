@@ -55,6 +55,57 @@ class MNIST1D(torch.utils.data.Dataset):
         return X, y
 
 
+class CUDAPrefetcher:
+    """
+    Wrap a DataLoader and copy each batch to the GPU on a side CUDA stream
+    while the previous batch is still being processed, hiding the
+    host-to-device transfer latency behind compute. Works with batches that
+    are tensors or (nested) lists/tuples of tensors, e.g. those produced by
+    StackDataset. Combine with pin_memory=True in the DataLoader so the
+    async copies can actually overlap.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _map_tensors(self, batch, func):
+        if isinstance(batch, torch.Tensor):
+            return func(batch)
+        elif isinstance(batch, (list, tuple)):
+            return type(batch)(self._map_tensors(b, func) for b in batch)
+        else:
+            return batch
+
+    def __iter__(self):
+        current_stream = torch.cuda.current_stream(self.device)
+        ready = None
+        for host_batch in self.loader:
+            # Issue the copy of the next batch on the side stream, then hand
+            # out the previous one. The GPU works on the previous batch while
+            # the copy is in flight.
+            with torch.cuda.stream(self.stream):
+                device_batch = self._map_tensors(
+                    host_batch,
+                    lambda x: x.to(self.device, non_blocking=True),
+                )
+            if ready is not None:
+                yield ready
+            # Make the default stream wait for the copy and tell the caching
+            # allocator that the tensors are used on it.
+            current_stream.wait_stream(self.stream)
+            self._map_tensors(
+                device_batch, lambda x: x.record_stream(current_stream)
+            )
+            ready = device_batch
+        if ready is not None:
+            yield ready
+
+
 def count_params(torch_model: torch.nn.Module):
     """
     function to calculate the number of trainable parameters of a torch.nn.Module